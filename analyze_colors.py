@@ -0,0 +1,358 @@
+import argparse
+import colorsys
+import json
+import re
+import sys
+import time
+from collections import Counter, defaultdict
+from itertools import product
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from results_store import add_history_arguments, get_history_database, record_run
+
+# Example: python3 analyze_colors.py -p properties.json -t 2.3
+
+# Roughly the smallest color difference people notice
+DEFAULT_DELTA_E = 2.3
+# Function calls (with one level of nested calls) are matched whole so colors passed to
+# e.g. darken(#f00, 10%) aren't counted as written
+COLOR_PATTERN = re.compile(
+    r'(?<![\w-])[\w-]+\((?:[^()]|\([^()]*\))*\)'
+    r'|#(?:[0-9a-fA-F]{8}|[0-9a-fA-F]{6}|[0-9a-fA-F]{3,4})(?![\w-])'
+    r'|(?<![\w$.#@-])[a-zA-Z]+(?![\w(-])', re.IGNORECASE)
+# Functions whose color arguments are used as written. Colors passed to any other function,
+# e.g. scss darken(), mix() or transparentize(), only derive a new color and are skipped.
+COLOR_ARGUMENT_FUNCTIONS = {
+    "rgb", "rgba", "hsl", "hsla", "var", "drop-shadow",
+    "linear-gradient", "radial-gradient", "conic-gradient",
+    "repeating-linear-gradient", "repeating-radial-gradient", "repeating-conic-gradient",
+    "-webkit-linear-gradient", "-webkit-radial-gradient",
+}
+# Properties that take colors, plus custom properties
+COLOR_PROPERTY_PATTERN = re.compile(
+    r'^(?:color|fill|stroke|background.*|border.*|outline.*|column-rule.*|.*-color|.*-shadow|--.*)$',
+    re.IGNORECASE)
+# Urls and quoted strings can contain words like `white` that aren't colors
+NON_COLOR_VALUE_PATTERN = re.compile(r'url\([^)]*\)|"[^"]*"|\'[^\']*\'', re.IGNORECASE)
+NUMBER_PATTERN = re.compile(r'^([+-]?(?:\d+\.?\d*|\.\d+)(?:e[+-]?\d+)?)(%|deg|rad|grad|turn)?$', re.IGNORECASE)
+
+NAMED_COLORS = {
+    "aliceblue": "f0f8ff", "antiquewhite": "faebd7", "aqua": "00ffff", "aquamarine": "7fffd4",
+    "azure": "f0ffff", "beige": "f5f5dc", "bisque": "ffe4c4", "black": "000000",
+    "blanchedalmond": "ffebcd", "blue": "0000ff", "blueviolet": "8a2be2", "brown": "a52a2a",
+    "burlywood": "deb887", "cadetblue": "5f9ea0", "chartreuse": "7fff00", "chocolate": "d2691e",
+    "coral": "ff7f50", "cornflowerblue": "6495ed", "cornsilk": "fff8dc", "crimson": "dc143c",
+    "cyan": "00ffff", "darkblue": "00008b", "darkcyan": "008b8b", "darkgoldenrod": "b8860b",
+    "darkgray": "a9a9a9", "darkgreen": "006400", "darkgrey": "a9a9a9", "darkkhaki": "bdb76b",
+    "darkmagenta": "8b008b", "darkolivegreen": "556b2f", "darkorange": "ff8c00", "darkorchid": "9932cc",
+    "darkred": "8b0000", "darksalmon": "e9967a", "darkseagreen": "8fbc8f", "darkslateblue": "483d8b",
+    "darkslategray": "2f4f4f", "darkslategrey": "2f4f4f", "darkturquoise": "00ced1", "darkviolet": "9400d3",
+    "deeppink": "ff1493", "deepskyblue": "00bfff", "dimgray": "696969", "dimgrey": "696969",
+    "dodgerblue": "1e90ff", "firebrick": "b22222", "floralwhite": "fffaf0", "forestgreen": "228b22",
+    "fuchsia": "ff00ff", "gainsboro": "dcdcdc", "ghostwhite": "f8f8ff", "gold": "ffd700",
+    "goldenrod": "daa520", "gray": "808080", "green": "008000", "greenyellow": "adff2f",
+    "grey": "808080", "honeydew": "f0fff0", "hotpink": "ff69b4", "indianred": "cd5c5c",
+    "indigo": "4b0082", "ivory": "fffff0", "khaki": "f0e68c", "lavender": "e6e6fa",
+    "lavenderblush": "fff0f5", "lawngreen": "7cfc00", "lemonchiffon": "fffacd", "lightblue": "add8e6",
+    "lightcoral": "f08080", "lightcyan": "e0ffff", "lightgoldenrodyellow": "fafad2", "lightgray": "d3d3d3",
+    "lightgreen": "90ee90", "lightgrey": "d3d3d3", "lightpink": "ffb6c1", "lightsalmon": "ffa07a",
+    "lightseagreen": "20b2aa", "lightskyblue": "87cefa", "lightslategray": "778899", "lightslategrey": "778899",
+    "lightsteelblue": "b0c4de", "lightyellow": "ffffe0", "lime": "00ff00", "limegreen": "32cd32",
+    "linen": "faf0e6", "magenta": "ff00ff", "maroon": "800000", "mediumaquamarine": "66cdaa",
+    "mediumblue": "0000cd", "mediumorchid": "ba55d3", "mediumpurple": "9370db", "mediumseagreen": "3cb371",
+    "mediumslateblue": "7b68ee", "mediumspringgreen": "00fa9a", "mediumturquoise": "48d1cc",
+    "mediumvioletred": "c71585", "midnightblue": "191970", "mintcream": "f5fffa", "mistyrose": "ffe4e1",
+    "moccasin": "ffe4b5", "navajowhite": "ffdead", "navy": "000080", "oldlace": "fdf5e6",
+    "olive": "808000", "olivedrab": "6b8e23", "orange": "ffa500", "orangered": "ff4500",
+    "orchid": "da70d6", "palegoldenrod": "eee8aa", "palegreen": "98fb98", "paleturquoise": "afeeee",
+    "palevioletred": "db7093", "papayawhip": "ffefd5", "peachpuff": "ffdab9", "peru": "cd853f",
+    "pink": "ffc0cb", "plum": "dda0dd", "powderblue": "b0e0e6", "purple": "800080",
+    "rebeccapurple": "663399", "red": "ff0000", "rosybrown": "bc8f8f", "royalblue": "4169e1",
+    "saddlebrown": "8b4513", "salmon": "fa8072", "sandybrown": "f4a460", "seagreen": "2e8b57",
+    "seashell": "fff5ee", "sienna": "a0522d", "silver": "c0c0c0", "skyblue": "87ceeb",
+    "slateblue": "6a5acd", "slategray": "708090", "slategrey": "708090", "snow": "fffafa",
+    "springgreen": "00ff7f", "steelblue": "4682b4", "tan": "d2b48c", "teal": "008080",
+    "thistle": "d8bfd8", "tomato": "ff6347", "turquoise": "40e0d0", "violet": "ee82ee",
+    "wheat": "f5deb3", "white": "ffffff", "whitesmoke": "f5f5f5", "yellow": "ffff00",
+    "yellowgreen": "9acd32",
+}
+
+# sRGB (D65) to CIE XYZ
+SRGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]])
+WHITE_D65 = np.array([0.95047, 1.0, 1.08883])
+LAB_EPSILON = 216 / 24389
+LAB_KAPPA = 24389 / 27
+
+
+def parse_number(token: str, scale: float, hue: bool = False) -> Optional[float]:
+    """
+    Parse a css number. Percentages are relative to `scale`, hues are converted to turns.
+    """
+    match = NUMBER_PATTERN.match(token)
+    if not match:
+        return None
+    value, unit = float(match.group(1)), (match.group(2) or "").lower()
+    if unit == "%":
+        return value / 100 * (1 if hue else scale)
+    if hue:
+        return {"": value / 360, "deg": value / 360, "grad": value / 400,
+                "rad": value / (2 * np.pi), "turn": value}.get(unit, value / 360) % 1
+    return None if unit else value
+
+
+def parse_color(token: str) -> Optional[Tuple[float, float, float, float]]:
+    """
+    Parse a hex, rgb()/rgba(), hsl()/hsla() or named css color.
+
+    Returns:
+    - color: (red, green, blue, alpha) tuple with values between 0 and 1, or None
+    """
+    token = token.strip().lower()
+    if token in NAMED_COLORS:
+        token = "#" + NAMED_COLORS[token]
+
+    if token.startswith("#"):
+        digits = token[1:]
+        if len(digits) in (3, 4):
+            digits = "".join(digit * 2 for digit in digits)
+        if len(digits) == 6:
+            digits += "ff"
+        if len(digits) != 8:
+            return None
+        return tuple(int(digits[i:i + 2], 16) / 255 for i in range(0, 8, 2))
+
+    function, _, arguments = token.partition("(")
+    if function not in ("rgb", "rgba", "hsl", "hsla"):
+        return None
+    parts = [part for part in re.split(r'[\s,/]+', arguments.rstrip(")").strip()) if part]
+
+    # scss rgba(#000, .5) or rgba(white, 50%)
+    if function.startswith("rgb") and len(parts) == 2 and "(" not in parts[0]:
+        color, alpha = parse_color(parts[0]), parse_number(parts[1], 1)
+        if color is None or alpha is None:
+            return None
+        return color[:3] + (min(max(alpha, 0.0), 1.0),)
+    if len(parts) not in (3, 4):
+        return None
+    alpha = parse_number(parts[3], 1) if len(parts) == 4 else 1.0
+    if alpha is None:
+        return None
+
+    if function.startswith("rgb"):
+        channels = [parse_number(part, 255) for part in parts[:3]]
+        if any(channel is None for channel in channels):
+            return None
+        red, green, blue = (channel / 255 for channel in channels)
+    else:
+        hue = parse_number(parts[0], 1, hue=True)
+        saturation, lightness = parse_number(parts[1], 1), parse_number(parts[2], 1)
+        if None in (hue, saturation, lightness) or not parts[1].endswith("%") or not parts[2].endswith("%"):
+            return None
+        red, green, blue = colorsys.hls_to_rgb(hue, lightness, saturation)
+    return tuple(min(max(channel, 0.0), 1.0) for channel in (red, green, blue, alpha))
+
+
+def to_hex(rgba) -> str:
+    channels = [int(round(channel * 255)) for channel in rgba]
+    if channels[3] == 255:
+        channels = channels[:3]
+    return "#" + "".join(f"{channel:02x}" for channel in channels)
+
+
+def srgb_to_lab(rgb: np.ndarray) -> np.ndarray:
+    """
+    Convert an (n, 3) array of sRGB values between 0 and 1 to CIELAB (D65).
+    """
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ SRGB_TO_XYZ.T / WHITE_D65
+    f = np.where(xyz > LAB_EPSILON, np.cbrt(xyz), (LAB_KAPPA * xyz + 16) / 116)
+    return np.stack([116 * f[:, 1] - 16,
+                     500 * (f[:, 0] - f[:, 1]),
+                     200 * (f[:, 1] - f[:, 2])], axis=1)
+
+
+def extract_colors(properties: List[List]) -> Tuple[Dict[str, Counter], Dict[str, Tuple]]:
+    """
+    Find every color in the values of color properties in properties.json rows. Colors
+    passed to functions that derive a new color, e.g. darken(#f00, 10%), are skipped.
+
+    Parameters:
+    - properties (List): [property, value, count] rows
+
+    Returns:
+    - colors: dict of normalized hex color -> Counter of how each was written
+    - rgba: dict of normalized hex color -> (red, green, blue, alpha) tuple
+    """
+    colors = defaultdict(Counter)
+    rgba_by_color = {}
+    parsed = {}
+    for name, value, count in properties:
+        if not COLOR_PROPERTY_PATTERN.match(name):
+            continue
+        tokens = COLOR_PATTERN.findall(NON_COLOR_VALUE_PATTERN.sub(" ", value))
+        while tokens:
+            token = tokens.pop()
+            if token not in parsed:
+                rgba = parse_color(token)
+                parsed[token] = to_hex(rgba) if rgba else None
+                if rgba:
+                    rgba_by_color.setdefault(parsed[token], rgba)
+            if parsed[token]:
+                colors[parsed[token]][token] += count
+            elif token.endswith(")") and token[:token.index("(")].lower() in COLOR_ARGUMENT_FUNCTIONS:
+                # Colors passed to a function we can't parse, e.g. rgba($base, #000, .5)
+                # or linear-gradient(#fff, rgba(0, 0, 0, .5))
+                tokens.extend(COLOR_PATTERN.findall(token[token.index("(") + 1:-1]))
+    return colors, rgba_by_color
+
+
+def cluster_colors(rgba: np.ndarray, counts: np.ndarray,
+                   threshold: float = DEFAULT_DELTA_E) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Group colors within `threshold` Delta E (CIE76) of each other. The most used colors
+    become cluster leaders and absorb unassigned colors around them, so clusters do not
+    chain. Colors are bucketed into a Lab grid with `threshold` sized cells, so each
+    leader only compares against the 27 neighbouring cells. Colors only cluster with
+    colors of the same alpha.
+
+    Parameters:
+    - rgba (ndarray): (n, 4) array of colors with values between 0 and 1
+    - counts (ndarray): number of uses of each color
+    - threshold (float): maximum Delta E from the cluster leader
+
+    Returns:
+    - leaders: for each color, the index of the color leading its cluster
+    - lab: (n, 3) array of the colors in CIELAB
+    """
+    lab = srgb_to_lab(rgba[:, :3])
+    alpha = np.round(rgba[:, 3] * 255).astype(np.int64)
+    cells = np.floor(lab / threshold).astype(np.int64)
+
+    keys = np.column_stack([cells, alpha])
+    unique_keys, cell_of_color = np.unique(keys, axis=0, return_inverse=True)
+    cell_of_color = cell_of_color.ravel()
+    order = np.argsort(cell_of_color, kind="stable")
+    boundaries = np.cumsum(np.bincount(cell_of_color, minlength=len(unique_keys)))[:-1]
+    members_by_cell = {tuple(key): members for key, members in
+                       zip(unique_keys.tolist(), np.split(order, boundaries))}
+
+    offsets = list(product((-1, 0, 1), repeat=3))
+    leaders = np.full(len(rgba), -1, dtype=np.int64)
+    for leader in np.argsort(-counts, kind="stable"):
+        if leaders[leader] != -1:
+            continue
+        cell_x, cell_y, cell_z, cell_alpha = keys[leader].tolist()
+        neighbours = [members_by_cell[key] for key in
+                      ((cell_x + dx, cell_y + dy, cell_z + dz, cell_alpha) for dx, dy, dz in offsets)
+                      if key in members_by_cell]
+        candidates = np.concatenate(neighbours)
+        candidates = candidates[leaders[candidates] == -1]
+        distances = np.linalg.norm(lab[candidates] - lab[leader], axis=1)
+        leaders[candidates[distances <= threshold]] = leader
+    return leaders, lab
+
+
+def analyze_colors(properties: List[List], threshold: float = DEFAULT_DELTA_E) -> List[Dict]:
+    """
+    Cluster the colors used in properties.json and suggest a css variable for each cluster.
+
+    Returns:
+    - clusters: list of clusters sorted by number of uses
+    """
+    colors, rgba_by_color = extract_colors(properties)
+    if not colors:
+        return []
+    hex_colors = list(colors)
+    counts = np.array([sum(colors[color].values()) for color in hex_colors])
+    rgba = np.array([rgba_by_color[color] for color in hex_colors])
+    leaders, lab = cluster_colors(rgba, counts, threshold)
+
+    members_by_leader = defaultdict(list)
+    for index, leader in enumerate(leaders.tolist()):
+        members_by_leader[leader].append(index)
+
+    clusters = []
+    for leader, members in members_by_leader.items():
+        members = sorted(members, key=lambda index: counts[index], reverse=True)
+        distances = np.linalg.norm(lab[members] - lab[leader], axis=1)
+        clusters.append({
+            "value": hex_colors[leader],
+            "count": int(counts[members].sum()),
+            "colors": [{"value": hex_colors[index],
+                        "delta_e": round(float(distance), 2),
+                        "count": int(counts[index]),
+                        "written_as": dict(colors[hex_colors[index]].most_common())}
+                       for index, distance in zip(members, distances)]})
+
+    clusters = sorted(clusters, key=lambda x: x["count"], reverse=True)
+    for rank, cluster in enumerate(clusters, start=1):
+        cluster["variable"] = f"--color-{rank}"
+    return clusters
+
+
+def save_color_variables(clusters: List[Dict], outfile: str) -> None:
+    """Writes a :root block declaring one css variable per cluster that could be consolidated."""
+    with open(outfile, 'w') as f:
+        f.write(":root {\n")
+        for cluster in clusters:
+            written_as = [spelling for color in cluster["colors"] for spelling in color["written_as"]]
+            if len(written_as) < 2:
+                continue
+            f.write(f"  {cluster['variable']}: {cluster['value']}; "
+                    f"/* {cluster['count']} uses: {', '.join(written_as)} */\n")
+        f.write("}\n")
+
+
+def parse_threshold(value: str) -> float:
+    """Parse a `--threshold` argument, which must be a positive Delta E."""
+    try:
+        threshold = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"threshold must be a number, got {value}")
+    if not threshold > 0:
+        raise argparse.ArgumentTypeError(f"threshold must be greater than 0, got {value}")
+    return threshold
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Find near duplicate colors in properties.json.')
+    parser.add_argument('-p', '--properties', type=str, default="properties.json",
+                        help='properties.json written by analyze_css_properties.py')
+    parser.add_argument('-t', '--threshold', type=parse_threshold, default=DEFAULT_DELTA_E,
+                        help='Maximum Delta E (CIE76) between colors in a cluster')
+    add_history_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        with open(args.properties, 'r') as f:
+            properties = json.load(f)
+    except (IOError, ValueError) as e:
+        print(f"Error reading {args.properties}: {e}")
+        sys.exit(1)
+
+    clusters = analyze_colors(properties, args.threshold)
+    colors = sum(len(cluster["colors"]) for cluster in clusters)
+    consolidate = [cluster for cluster in clusters if len(cluster["colors"]) > 1]
+    print(f'Found {colors} distinct colors in {len(clusters)} clusters')
+    print(f'Found {len(consolidate)} clusters of near duplicate colors')
+
+    with open("color_clusters.json", "w") as f:
+        json.dump(clusters, f, indent=4)
+    save_color_variables(clusters, "color_variables.css")
+
+    history_database = get_history_database(args)
+    if history_database:
+        record_run(history_database, "analyze_colors", {
+            "color_clusters": {cluster["value"]: cluster["count"] for cluster in clusters},
+            "near_duplicate_colors": {cluster["value"]: len(cluster["colors"]) for cluster in consolidate}})
+
+
+if __name__ == "__main__":
+    start_time = time.perf_counter()
+    main()
+    end_time = time.perf_counter()
+    elapsed_time = end_time - start_time
+    print(f"Time taken to complete main method: {elapsed_time:.2f} seconds")
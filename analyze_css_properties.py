@@ -5,7 +5,9 @@ import time
 import sys
 from pathlib import Path
 from collections import Counter
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
+from results_store import add_history_arguments, get_history_database, record_run
+from shards import count_by_first_occurrence, merge_counts, parse_shard, select_shard, write_partial
 
 DEFAULT_EXCLUDE_DIRS = ["bourbon", "custom", "neat"]
 ALL_CSS_VALUES = r'^\s*([\w-]*):\s*([^;]*)'
@@ -131,10 +133,64 @@ def get_all_class_properties(file_list: List[str]) -> List[List[str]]:
         css_class_properties.extend(extract_class_properties_by_file(file_path))
     return css_class_properties
 
+def save_class_properties(class_properties: Counter) -> None:
+    updated_class_properties = [[item, count] for item, count in class_properties.items()]
+    updated_class_properties = sorted(updated_class_properties, key=lambda x: x[-1], reverse=True)
+    
+    with open("class_properties.json", "w") as f:
+        json.dump(updated_class_properties, f, indent=4)
+
+def save_properties(properties: Counter) -> None:
+    updated_properties = [item + (count,) for item, count in properties.items()]
+    updated_properties = sorted(updated_properties, key=lambda x: x[-1], reverse=True)
+
+    print(f'Found {len(updated_properties)} propertes')
+    
+    with open("properties.json", "w") as f:
+        json.dump(updated_properties, f, indent=4)
+
+def save_history(database: str, class_properties: Counter, properties: Counter) -> None:
+    record_run(database, "analyze_css_properties", {
+        "class_properties": class_properties,
+        "properties": {f"{name}: {value}": count for (name, value), count in properties.items()}})
+
+def save_partial(file_list: List[str], shard: Tuple[int, int]) -> None:
+    """
+    Process the files of one shard and write a partial result with counts and the
+    position each item was first seen, so merged output keeps single run ordering.
+    """
+    shard_files = select_shard(file_list, shard)
+    print(f'Processing {len(shard_files)} scss files in shard {shard[0]}/{shard[1]}')
+
+    class_properties = count_by_first_occurrence(
+        (position, extract_class_properties_by_file(Path(filename))) for position, filename in shard_files)
+    properties = count_by_first_occurrence(
+        (position, extract_css_properties_and_values_by_file(Path(filename), ALL_CSS_VALUES))
+        for position, filename in shard_files)
+
+    filename = write_partial("css_properties", shard, [file_list], {
+        "class_properties": [[item, *entry] for item, entry in class_properties.items()],
+        "properties": [[*item, *entry] for item, entry in properties.items()]})
+    print(f'Wrote {filename}')
+
+def merge_partials(partials: List[Dict], history_database: Optional[str] = None) -> None:
+    """Combine partial results from every shard into class_properties.json and properties.json."""
+    class_properties = merge_counts([entry for partial in partials for entry in partial["class_properties"]])
+    print(f'Found {sum(class_properties.values())} propertes')
+    save_class_properties(class_properties)
+    properties = merge_counts([entry for partial in partials for entry in partial["properties"]])
+    save_properties(properties)
+
+    if history_database:
+        save_history(history_database, class_properties, properties)
+
 def main() -> None:
     parser = argparse.ArgumentParser(description='Process SCSS files.')
     parser.add_argument('-d', '--directory', type=str, required=True, nargs='+',
                         help='The directory with scss files to be processed')
+    parser.add_argument('-s', '--shard', type=parse_shard, default=None,
+                        help='Only process shard i of N (e.g. 2/4) and write a partial result')
+    add_history_arguments(parser)
 
     args = parser.parse_args()
     
@@ -143,24 +199,21 @@ def main() -> None:
     for path in args.directory:
         scss_files.extend(collect_style_files_in_directory(path))
     print(f'Found {len(scss_files)} scss files')
-    
-    class_properties = get_all_class_properties(scss_files)
-    print(f'Found {len(class_properties)} propertes')
 
-    updated_class_properties = [[item, count] for item, count in Counter(class_properties).items()]
-    updated_class_properties = sorted(updated_class_properties, key=lambda x: x[-1], reverse=True)
+    if args.shard:
+        save_partial(scss_files, args.shard)
+        return
     
-    with open("class_properties.json", "w") as f:
-        json.dump(updated_class_properties, f, indent=4)
+    class_properties = Counter(get_all_class_properties(scss_files))
+    print(f'Found {sum(class_properties.values())} propertes')
+    save_class_properties(class_properties)
 
-    properties = get_all_css_properties_and_values(scss_files)
-    updated_properties = [item + (count,) for item, count in Counter(properties).items()]
-    updated_properties = sorted(updated_properties, key=lambda x: x[-1], reverse=True)
+    properties = Counter(get_all_css_properties_and_values(scss_files))
+    save_properties(properties)
 
-    print(f'Found {len(updated_properties)} propertes')
-    
-    with open("properties.json", "w") as f:
-        json.dump(updated_properties, f, indent=4)
+    history_database = get_history_database(args)
+    if history_database:
+        save_history(history_database, class_properties, properties)
 
 if __name__ == "__main__":
     start_time = time.perf_counter()
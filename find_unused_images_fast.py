@@ -1,14 +1,32 @@
 import argparse
+import hashlib
 import json
+import re
 import sys
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Set
+from typing import Dict, List, Optional, Set, Tuple
 import ahocorasick
+from results_store import add_history_arguments, get_history_database, record_run
+from shards import parse_shard, select_shard, write_partial
 
 DEFAULT_EXCLUDE_DIRS = ["bourbon", "custom", "neat"]
 VARIABLE_USAGE_PATTERN = r'var\((--[a-zA-Z0-9-]+)\)'
 VARIABLE_DECLARATION_PATTERN = r'(--[\w-]+):'
+PARTIAL_HASH_BYTES = 4096
+HASH_CHUNK_BYTES = 1024 * 1024
+PERCEPTUAL_HASH_EXTENSIONS = {".png", ".jpg", ".jpeg"}
+PERCEPTUAL_HASH_BITS = 64
+DEFAULT_PERCEPTUAL_THRESHOLD = 5
+# 'flag-' + country + '.svg' or name + '.svg'
+CONCATENATION_PATTERN = re.compile(
+    r"""(['"])([^'"\n]*)\1\s*\+\s*[\w.$\[\]()]+(?:\s*\+\s*(['"])([^'"\n]*)\3)?"""
+    r"""|[\w.$\[\]()]+\s*\+\s*(['"])([^'"\n]*)\5""")
+# `icons/${name}.png`, url("flags/#{$name}.svg") or src="flags/{{country}}.svg"
+INTERPOLATION_PATTERN = re.compile(r'([\w./-]*)(?:[$#]\{[^}\n]*\}|\{\{[^}\n]*\}\})([\w.-]*)')
+EXTENSION_ONLY_PATTERN = re.compile(r'\.\w+')
 
 def collect_files_in_directory(directory: str, exclude: List[str] = DEFAULT_EXCLUDE_DIRS, extension : str = "*") -> List[Path]:
     """
@@ -76,14 +94,394 @@ def get_used_images_by_files(file_dict, images):
 
     return used_images
 
+def split_prefix_fragment(fragment: str) -> Tuple[str, str]:
+    """
+    Split the string before an interpolation point into the directory it names and
+    the start of the image name, e.g. 'assets/flags/flag-' -> ('flags', 'flag-').
+    """
+    head, _, prefix = fragment.rpartition('/')
+    return head.rpartition('/')[2], prefix
+
+def extract_interpolation_fragments(content: str) -> Set[Tuple[str, str, str]]:
+    """
+    Find string fragments next to interpolation points, i.e. strings built with `+`,
+    template literals, scss interpolation and `{{...}}` templates.
+
+    Parameters:
+    - content (str): File content
+
+    Returns:
+    - fragments: set of (directory, prefix, suffix) tuples. Empty strings mean unknown.
+    """
+    fragments = set()
+    for match in CONCATENATION_PATTERN.finditer(content):
+        before = match.group(2) or ""
+        after = match.group(4) if match.group(2) is not None else match.group(6)
+        directory, prefix = split_prefix_fragment(before)
+        suffix = re.split(r'[/?#]', after or "", maxsplit=1)[0]
+        fragments.add((directory, prefix, suffix))
+    for match in INTERPOLATION_PATTERN.finditer(content):
+        directory, prefix = split_prefix_fragment(match.group(1))
+        fragments.add((directory, prefix, match.group(2)))
+    # A bare extension with nothing else to go on would match every image of that type
+    return {(directory, prefix, suffix) for directory, prefix, suffix in fragments
+            if directory or prefix or (suffix and not EXTENSION_ONLY_PATTERN.fullmatch(suffix))}
+
+def build_trie(words: List[str]) -> List[Dict[str, int]]:
+    """
+    Build a character trie stored as a list of nodes, where each node maps a
+    character to the index of the child node. Node 0 is the root.
+    """
+    trie = [{}]
+    for word in words:
+        node = 0
+        for char in word:
+            child = trie[node].get(char)
+            if child is None:
+                child = len(trie)
+                trie[node][char] = child
+                trie.append({})
+            node = child
+    return trie
+
+def walk_trie(trie: List[Dict[str, int]], word: str) -> List[int]:
+    """
+    Return the nodes visited while walking `word` from the root, starting with the root.
+    The walk stops early when the trie has no matching child.
+    """
+    node, path = 0, [0]
+    for char in word:
+        node = trie[node].get(char)
+        if node is None:
+            break
+        path.append(node)
+    return path
+
+def get_possibly_used_images_by_files(file_dict, image_files: List[Path]) -> Set[str]:
+    """
+    Find images that may be referenced through dynamically built names. Fragments are
+    looked up in a prefix trie and a reversed suffix trie of image names, then each
+    image walks both tries once to check whether any fragment matches it.
+
+    Parameters:
+    - file_dict (Dict): A dict of file name and file content
+    - image_files (List): List of image paths
+
+    Returns:
+    - possibly_used_images: set of image names matching a dynamic reference
+    """
+    names = list(dict.fromkeys(path.name for path in image_files))
+    prefix_trie = build_trie(names)
+    suffix_trie = build_trie([name[::-1] for name in names])
+
+    # prefix node -> suffix node -> directories ("" matches any directory, otherwise
+    # any folder above the image)
+    matchers = defaultdict(lambda: defaultdict(set))
+    for content in file_dict.values():
+        for directory, prefix, suffix in extract_interpolation_fragments(content):
+            prefix_path = walk_trie(prefix_trie, prefix)
+            suffix_path = walk_trie(suffix_trie, suffix[::-1])
+            if len(prefix_path) == len(prefix) + 1 and len(suffix_path) == len(suffix) + 1:
+                matchers[prefix_path[-1]][suffix_path[-1]].add(directory)
+
+    possibly_used_images = set()
+    for path in image_files:
+        name = path.name
+        if name in possibly_used_images:
+            continue
+        suffix_nodes = walk_trie(suffix_trie, name[::-1])
+        # The interpolated part can contain folders, so the directory may be any folder above the image
+        folders = set(path.parent.parts)
+        for prefix_node in walk_trie(prefix_trie, name):
+            if prefix_node not in matchers:
+                continue
+            suffix_matchers = matchers[prefix_node]
+            if any(directory == "" or directory in folders
+                   for suffix_node in suffix_nodes if suffix_node in suffix_matchers
+                   for directory in suffix_matchers[suffix_node]):
+                possibly_used_images.add(name)
+                break
+
+    return possibly_used_images
+
+def hash_file(file_path: Path, limit: Optional[int] = None) -> str:
+    """
+    Hash a file in fixed size chunks so large images are never fully read into memory.
+
+    Parameters:
+    - file_path (Path): Path to the file.
+    - limit (int): Only hash the first `limit` bytes. Hashes the whole file when None.
+
+    Returns:
+    - digest: hex digest of the hashed bytes
+    """
+    digest = hashlib.blake2b()
+    remaining = limit
+    with file_path.open('rb') as file:
+        while remaining is None or remaining > 0:
+            chunk_size = HASH_CHUNK_BYTES if remaining is None else min(HASH_CHUNK_BYTES, remaining)
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest.hexdigest()
+
+def perceptual_hash(file_path: Path) -> int:
+    """
+    Compute a 64 bit difference hash (dHash) so re-encoded or resized copies of
+    the same image end up with the same or a very similar hash. Requires Pillow.
+
+    Parameters:
+    - file_path (Path): Path to a png or jpg image.
+
+    Returns:
+    - digest: 64 bit integer
+    """
+    from PIL import Image
+
+    with Image.open(file_path) as image:
+        pixels = image.convert("L").resize((9, 8)).tobytes()
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left, right = pixels[row * 9 + col], pixels[row * 9 + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+def hash_files(files: List[Path], hasher, workers: Optional[int] = None,
+                errors: Tuple = (OSError,)) -> Dict[Path, object]:
+    """
+    Hash files in a thread pool. Files that can't be read or decoded are reported
+    and left out.
+
+    Parameters:
+    - files (List): List of file paths
+    - hasher (callable): Function taking a path and returning a digest.
+    - workers (int): Number of hashing threads, defaults to the executor default.
+    - errors (Tuple): Exceptions that only skip the file they were raised for.
+
+    Returns:
+    - digests: dict of file path and digest
+    """
+    def safe_hasher(file_path):
+        try:
+            return hasher(file_path)
+        except errors as e:
+            print(f"Error opening or reading {file_path}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return {file_path: digest for file_path, digest in zip(files, executor.map(safe_hasher, files))
+                if digest is not None}
+
+def group_by_hash(files: List[Path], hasher, workers: Optional[int] = None) -> List[List[Path]]:
+    """
+    Hash files in a thread pool and group them by digest.
+
+    Parameters:
+    - files (List): List of file paths
+    - hasher (callable): Function taking a path and returning a digest.
+    - workers (int): Number of hashing threads, defaults to the executor default.
+
+    Returns:
+    - groups: list of groups with more than one file sharing a digest
+    """
+    groups = defaultdict(list)
+    for file_path, digest in hash_files(files, hasher, workers).items():
+        groups[digest].append(file_path)
+    return [group for group in groups.values() if len(group) > 1]
+
+def group_by_perceptual_hash(files: List[Path], threshold: int = DEFAULT_PERCEPTUAL_THRESHOLD,
+                             workers: Optional[int] = None) -> List[List[Path]]:
+    """
+    Group images by perceptual hash. The most common hash not yet grouped leads a
+    group and takes every ungrouped image whose hash differs from it in at most
+    `threshold` bits, so matches are never chained through other images.
+
+    The hash is split into threshold + 1 bands. Two hashes within the threshold must
+    agree on at least one whole band, so a leader is only compared with hashes sharing
+    one of its bands.
+
+    Parameters:
+    - files (List): List of png/jpg paths
+    - threshold (int): Maximum Hamming distance from the hash leading a group.
+    - workers (int): Number of hashing threads.
+
+    Returns:
+    - groups: list of groups with more than one image
+    """
+    from PIL import Image
+
+    # UnidentifiedImageError is an OSError, DecompressionBombError is not
+    digests_by_path = hash_files(files, perceptual_hash, workers,
+                                 errors=(OSError, Image.DecompressionBombError))
+    paths_by_hash = defaultdict(list)
+    for file_path, digest in digests_by_path.items():
+        paths_by_hash[digest].append(file_path)
+
+    band_count = threshold + 1
+    band_bits = PERCEPTUAL_HASH_BITS // band_count
+    bands = []
+    for band in range(band_count):
+        shift = band * band_bits
+        width = PERCEPTUAL_HASH_BITS - shift if band == band_count - 1 else band_bits
+        bands.append((shift, (1 << width) - 1))
+
+    buckets = defaultdict(list)
+    for digest in paths_by_hash:
+        for band, (shift, mask) in enumerate(bands):
+            buckets[(band, (digest >> shift) & mask)].append(digest)
+
+    grouped = set()
+    groups = []
+    for leader in sorted(paths_by_hash, key=lambda digest: (-len(paths_by_hash[digest]), digest)):
+        if leader in grouped:
+            continue
+        members = [leader]
+        grouped.add(leader)
+        for band, (shift, mask) in enumerate(bands):
+            for digest in buckets[(band, (leader >> shift) & mask)]:
+                if digest not in grouped and bin(leader ^ digest).count("1") <= threshold:
+                    members.append(digest)
+                    grouped.add(digest)
+        group = [path for digest in members for path in paths_by_hash[digest]]
+        if len(group) > 1:
+            groups.append(group)
+    return groups
+
+def find_duplicate_images(image_files: List[Path], perceptual: bool = False,
+                          workers: Optional[int] = None,
+                          perceptual_threshold: int = DEFAULT_PERCEPTUAL_THRESHOLD) -> Dict[str, object]:
+    """
+    Find byte-identical images, and optionally near-identical png/jpg variants.
+
+    Images are bucketed by size first, so only size collisions are hashed. Those are
+    narrowed with a hash of the first block before the full content is hashed.
+
+    Parameters:
+    - image_files (List): List of image paths
+    - perceptual (bool): Also group png/jpg images by perceptual hash.
+    - workers (int): Number of hashing threads.
+    - perceptual_threshold (int): Maximum number of differing perceptual hash bits.
+
+    Returns:
+    - report: duplicate groups, near duplicate groups and total bytes wasted
+    """
+    sizes = {}
+    by_size = defaultdict(list)
+    for path in dict.fromkeys(image_files):
+        if path.is_file():
+            sizes[path] = path.stat().st_size
+            by_size[sizes[path]].append(path)
+
+    candidates = [path for paths in by_size.values() if len(paths) > 1 for path in paths]
+    # Group by size and partial hash together so equal prefixes of different sizes never mix
+    partial_groups = group_by_hash(
+        candidates, lambda path: f"{sizes[path]}:{hash_file(path, PARTIAL_HASH_BYTES)}", workers)
+    candidates = [path for group in partial_groups for path in group]
+    exact_groups = group_by_hash(
+        candidates, lambda path: f"{sizes[path]}:{hash_file(path)}", workers)
+
+    duplicates = []
+    group_by_path = {}
+    for index, group in enumerate(exact_groups):
+        size = sizes[group[0]]
+        duplicates.append({"size": size,
+                           "bytes_wasted": size * (len(group) - 1),
+                           "files": sorted(str(path) for path in group)})
+        group_by_path.update({path: index for path in group})
+
+    near_duplicates = []
+    if perceptual:
+        images = [path for path in sizes if path.suffix.lower() in PERCEPTUAL_HASH_EXTENSIONS]
+        for group in group_by_perceptual_hash(images, perceptual_threshold, workers):
+            # Skip groups that are entirely byte-identical, they are already reported
+            if len({group_by_path.get(path, path) for path in group}) == 1:
+                continue
+            group_sizes = [sizes[path] for path in group]
+            near_duplicates.append({"bytes_wasted": sum(group_sizes) - max(group_sizes),
+                                    "files": sorted(str(path) for path in group)})
+
+    duplicates = sorted(duplicates, key=lambda x: x["bytes_wasted"], reverse=True)
+    near_duplicates = sorted(near_duplicates, key=lambda x: x["bytes_wasted"], reverse=True)
+    return {"bytes_wasted": sum(group["bytes_wasted"] for group in duplicates),
+            "near_duplicate_bytes_wasted": sum(group["bytes_wasted"] for group in near_duplicates),
+            "duplicates": duplicates,
+            "near_duplicates": near_duplicates}
+
+def save_image_results(images: List[str], used_images: Set[str], possibly_used_images: Set[str],
+                       history_database: Optional[str] = None) -> None:
+    possibly_used_images = possibly_used_images - used_images
+    unused_images = [image for image in dict.fromkeys(images)
+                     if image not in used_images and image not in possibly_used_images]
+    print(f'Found {len(used_images)} used images')
+    print(f'Found {len(possibly_used_images)} possibly used images')
+    print(f'Found {len(unused_images)} unused images')
+    with open("possibly_used_images.json", "w") as f:
+        json.dump(sorted(possibly_used_images), f, indent=4)
+    with open("unused_images.json", "w") as f:
+        json.dump(unused_images, f, indent=4)
+
+    if history_database:
+        record_run(history_database, "find_unused_images_fast", {
+            "unused_images": unused_images,
+            "possibly_used_images": possibly_used_images})
+
+def merge_partials(partials: List[Dict], history_database: Optional[str] = None) -> None:
+    """Combine partial results from every shard into the same files a single run writes."""
+    # Only the first shard stores the image list, read_partials checks every shard saw the same one
+    images = next(partial["images"] for partial in partials if partial["shard"][0] == 1)
+    with open("all_images.json", "w") as f:
+        json.dump(images, f, indent=4)
+
+    files = sorted(entry for partial in partials for entry in partial["files"])
+    with open("all_files.json", "w") as f:
+        json.dump([name for _, name in files], f, indent=4)
+
+    used_images = {image for partial in partials for image in partial["used"]}
+    possibly_used_images = {image for partial in partials for image in partial["possibly_used"]}
+    save_image_results(images, used_images, possibly_used_images, history_database)
+
+def parse_perceptual_threshold(value: str) -> int:
+    threshold = int(value)
+    if not 0 <= threshold < PERCEPTUAL_HASH_BITS // 2:
+        raise argparse.ArgumentTypeError(
+            f"perceptual threshold must be between 0 and {PERCEPTUAL_HASH_BITS // 2 - 1}, got {value}")
+    return threshold
+
 def main() -> None:
     parser = argparse.ArgumentParser(description='Process SCSS files.')
     parser.add_argument('-i', '--images', type=str, required=True, nargs='+',
                         help='The directory with scss files to be processed')
     parser.add_argument('-f', '--files', type=str, required=True, nargs='+',
                         help='File(s) where css variables are declared')
+    parser.add_argument('-D', '--duplicates', action='store_true',
+                        help='Write duplicate_images.json with byte-identical images')
+    parser.add_argument('-p', '--perceptual', action='store_true',
+                        help='With --duplicates, also group near-identical png/jpg images (requires Pillow)')
+    parser.add_argument('--perceptual-threshold', type=parse_perceptual_threshold, default=None,
+                        help='Maximum number of differing bits between perceptual hashes of near duplicates')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of threads used to hash images')
+    parser.add_argument('-s', '--shard', type=parse_shard, default=None,
+                        help='Only scan shard i of N (e.g. 2/4) of the files and write a partial result')
+    add_history_arguments(parser)
     args = parser.parse_args()
 
+    if args.perceptual and not args.duplicates:
+        parser.error("--perceptual requires --duplicates")
+    if args.perceptual_threshold is not None and not args.perceptual:
+        parser.error("--perceptual-threshold requires --perceptual")
+    if args.perceptual:
+        try:
+            import PIL
+        except ImportError:
+            parser.error("--perceptual requires Pillow, install it with `pip install pillow`")
+    if args.perceptual_threshold is None:
+        args.perceptual_threshold = DEFAULT_PERCEPTUAL_THRESHOLD
+
     # Get images 
     image_files = []
     for path in args.images:
@@ -93,8 +491,20 @@ def main() -> None:
 
     images = [image.name for image in image_files]
 
-    with open("all_images.json", "w") as f:
-        json.dump(list(images), f, indent=4)
+    if not args.shard:
+        with open("all_images.json", "w") as f:
+            json.dump(list(images), f, indent=4)
+
+    if args.duplicates:
+        report = find_duplicate_images(image_files, args.perceptual, args.workers,
+                                       args.perceptual_threshold)
+        print(f'Found {len(report["duplicates"])} duplicate image groups '
+              f'wasting {report["bytes_wasted"]} bytes')
+        if args.perceptual:
+            print(f'Found {len(report["near_duplicates"])} near duplicate image groups '
+                  f'wasting {report["near_duplicate_bytes_wasted"]} bytes')
+        with open("duplicate_images.json", "w") as f:
+            json.dump(report, f, indent=4)
 
     # Get all html, ts, js, scss, css files 
     files = []
@@ -107,19 +517,33 @@ def main() -> None:
     
     print(f'Found {len(files)} html , js, ts, scss, css files')
 
-    with open("all_files.json", "w") as f:
-        filenames = [file.name for file in files]
-        json.dump(filenames, f, indent=4)
+    if args.shard:
+        all_files = files
+        shard_files = select_shard(files, args.shard)
+        files = [file for _, file in shard_files]
+        print(f'Scanning {len(files)} files in shard {args.shard[0]}/{args.shard[1]}')
+    else:
+        with open("all_files.json", "w") as f:
+            filenames = [file.name for file in files]
+            json.dump(filenames, f, indent=4)
     
     file_dict = read_files_into_memory(files)
     print(f'Read {len(file_dict.keys())} files into memory')
 
     used_images = get_used_images_by_files(file_dict, images)
-    unused_images = set(images) - used_images
-    print(f'Found {len(used_images)} used images')
-    print(f'Found {len(unused_images)} used images')
-    with open("unused_images.json", "w") as f:
-        json.dump(list(unused_images), f, indent=4)
+    possibly_used_images = get_possibly_used_images_by_files(file_dict, image_files)
+
+    if args.shard:
+        data = {"files": [[position, file.name] for position, file in shard_files],
+                "used": sorted(used_images),
+                "possibly_used": sorted(possibly_used_images)}
+        if args.shard[0] == 1:
+            data["images"] = images
+        filename = write_partial("images", args.shard, [image_files, all_files], data)
+        print(f'Wrote {filename}')
+        return
+
+    save_image_results(images, used_images, possibly_used_images, get_history_database(args))
 
 if __name__ == "__main__":
     start_time = time.perf_counter()
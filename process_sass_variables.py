@@ -1,11 +1,82 @@
 import argparse
 import re
 import sys
+from array import array
 from collections import Counter
+from results_store import add_history_arguments, get_history_database, record_run
 
 # Example: python3 process_sass_variables.py -f ngx_variables.scss base_variables.scss
 
 
+class StringTable:
+    """Interns strings so each distinct string is stored once and referenced by an integer code."""
+    __slots__ = ("codes", "strings")
+
+    def __init__(self):
+        self.codes = {}
+        self.strings = []
+
+    def code(self, string):
+        code = self.codes.get(string)
+        if code is None:
+            code = len(self.strings)
+            self.codes[string] = code
+            self.strings.append(string)
+        return code
+
+    def __getitem__(self, code):
+        return self.strings[code]
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class VariableOccurrences:
+    """Column store of variable occurrences.
+
+    Every occurrence is a row holding integer codes into the interned filename, id and
+    value tables. Rows for each variable are kept in declaration order.
+    """
+    __slots__ = ("filenames", "ids", "values", "filename_column", "id_column",
+                 "value_column", "rows_by_variable")
+
+    def __init__(self):
+        self.filenames = StringTable()
+        self.ids = StringTable()
+        self.values = StringTable()
+        self.filename_column = array("I")
+        self.id_column = array("I")
+        self.value_column = array("I")
+        self.rows_by_variable = {}
+
+    def add(self, variable, value, filename, id):
+        rows = self.rows_by_variable.get(variable)
+        if rows is None:
+            rows = self.rows_by_variable[variable] = array("I")
+        rows.append(len(self.value_column))
+        self.filename_column.append(self.filenames.code(filename))
+        self.id_column.append(self.ids.code(id))
+        self.value_column.append(self.values.code(value))
+
+    def filename(self, row):
+        return self.filenames[self.filename_column[row]]
+
+    def id(self, row):
+        return self.ids[self.id_column[row]]
+
+    def value(self, row):
+        return self.values[self.value_column[row]]
+
+    def items(self):
+        return self.rows_by_variable.items()
+
+    def __iter__(self):
+        return iter(self.rows_by_variable)
+
+    def __len__(self):
+        return len(self.rows_by_variable)
+
+
 def get_file_content(filename):
     """Reads the content of a file."""
     try:
@@ -24,11 +95,18 @@ def get_sass_variables(content):
     return {match[0].strip(): match[1].strip() for match in matches}
 
 
+CSS_VARIABLE_PATTERN = re.compile(r"(\--[\w-]+):\s+([^;]+);", re.MULTILINE)
+
+
 def get_css_variables(content):
     """Extracts CSS variables from the content."""
-    pattern = re.compile(r"(\--[\w-]+):\s+([^;]+);", re.MULTILINE)
-    matches = pattern.findall(content)
-    return {match[0].strip(): match[1].strip() for match in matches}
+    return dict(iter_css_variables(content))
+
+
+def iter_css_variables(content):
+    """Yields (variable, value) pairs for the CSS variables in the content, in declaration order."""
+    for match in CSS_VARIABLE_PATTERN.finditer(content):
+        yield match[1].strip(), match[2].strip()
 
 
 def clean_file(content):
@@ -52,30 +130,22 @@ def clean_file(content):
     return content
 
 
-def get_css_variables_by_id(content, filename):
-    """Extracts CSS variables by element ID from the content."""
+def get_css_variables_by_id(content):
+    """Yields (id, variable, value) rows for the CSS variables declared in each element of the content."""
     content = clean_file(content)
     pattern = re.compile(r"\|([\w-]+)\s*\|([^\|]*)\|", re.MULTILINE)
 
     # pattern = re.compile(r":(\w+)\s*\{([^\n\n]*)}", re.MULTILINE) need to fix to account for variables
-    matches = pattern.findall(content)
-    results = []
-
-    for match in matches:
-        id = match[0].strip(':').strip("#").strip()
-        properties = get_css_variables(match[1])
-        results.append({"filename": f"{filename}",
-                       "id": f"{id}", "data": properties})
-    return results
+    for match in pattern.finditer(content):
+        id = match[1].strip(':').strip("#").strip()
+        for variable, value in iter_css_variables(match[2]):
+            yield id, variable, value
 
 
 def add_variables(variables, new_variables, filename, id="root"):
     """Adds new variables to the existing ones."""
     for variable, value in new_variables.items():
-        if variable not in variables:
-            variables[variable] = []
-        variables[variable].append(
-            {"filename": filename, "value": value, "id": id})
+        variables.add(variable, value, filename, id)
     return variables
 
 
@@ -85,21 +155,27 @@ def extract_values_by_index(array, indices):
 
 
 def analyze_variables_by_file(variables, outfile, is_css=False):
-    """Analyzes and writes unique, duplicate, and conflicting variables to a file."""
-    def get_row_to_print(variable, value):
+    """Analyzes and writes unique, duplicate, and conflicting variables to a file.
+
+    Returns a dict of category (unique, duplicate, conflicting, confused) to a
+    Counter of variable -> number of declarations in that category.
+    """
+    value_column, id_column = variables.value_column, variables.id_column
+
+    def get_row_to_print(variable, row):
         if (is_css):
-            return f"{variable}: {value['value']}; //{value['filename']}.{value['id']}\n"
-        return f"{variable}: {value['value']}; //{value['filename']}\n"
+            return f"{variable}: {variables.value(row)}; //{variables.filename(row)}.{variables.id(row)}\n"
+        return f"{variable}: {variables.value(row)}; //{variables.filename(row)}\n"
 
-    def get_duplicates_by_value(values):
-        value_counts = Counter([elem['value'] for elem in values])
+    def get_duplicates_by_value(rows):
+        value_counts = Counter([value_column[row] for row in rows])
         return {value for value, count in value_counts.items() if count > 1}
 
-    def get_conflicts_by_id(values):
+    def get_conflicts_by_id(rows):
         id_values = {}
         conflicts = set()
-        for obj in values:
-            id, value = obj['id'], obj['value']
+        for row in rows:
+            id, value = id_column[row], value_column[row]
             if id in id_values and id_values[id] != value:
                 conflicts.add(id)
             id_values[id] = value
@@ -110,31 +186,36 @@ def analyze_variables_by_file(variables, outfile, is_css=False):
             f.write(":cssVariables{\n")
 
         unique, duplicate, conflict, confused = "", "", "", ""
+        categories = {category: Counter() for category in
+                      ("unique", "duplicate", "conflicting", "confused")}
 
         for variable, values in variables.items():
             # There is only one defined value
             if len(values) == 1:
                 unique += get_row_to_print(variable, values[0])
+                categories["unique"][variable] = 1
             else:
                 duplicate_values = get_duplicates_by_value(values)
-                duplicate_indices = [i for val in duplicate_values for i, obj in enumerate(
-                    values) if obj['value'] == val]
+                duplicate_indices = [i for val in duplicate_values for i, row in enumerate(
+                    values) if value_column[row] == val]
                 duplicates = extract_values_by_index(values, duplicate_indices)
 
                 # Get duplicate values
                 if len(duplicates) >= 1:
                     duplicate += "".join(get_row_to_print(variable, val)
                                          for val in duplicates) + "\n"
+                    categories["duplicate"][variable] = len(duplicates)
 
                 conflict_values = get_conflicts_by_id(values)
-                conflict_indices = [i for val in conflict_values for i, obj in enumerate(
-                    values) if obj['id'] == val]
+                conflict_indices = [i for val in conflict_values for i, row in enumerate(
+                    values) if id_column[row] == val]
                 conflicts = extract_values_by_index(values, conflict_indices)
 
                 # Get conflicts
                 if len(conflicts) >= 1:
                     conflict += "".join(get_row_to_print(variable, val)
                                         for val in conflicts) + "\n"
+                    categories["conflicting"][variable] = len(conflicts)
 
                 conflict_or_dupe = list(
                     set(duplicate_indices).symmetric_difference(set(conflict_indices)))
@@ -145,6 +226,7 @@ def analyze_variables_by_file(variables, outfile, is_css=False):
                 if len(remainder) >= 1:
                     confused += "".join(get_row_to_print(variable, val)
                                         for val in remainder) + "\n"
+                    categories["confused"][variable] = len(remainder)
 
         f.write("// Unique Values\n")
         f.write(unique)
@@ -158,6 +240,8 @@ def analyze_variables_by_file(variables, outfile, is_css=False):
         if is_css:
             f.write("}\n")
 
+    return categories
+
 
 def save_unique_variables(variables, outfile):
     list_of_variables = sorted(
@@ -171,31 +255,36 @@ def main():
     parser = argparse.ArgumentParser(description='Process SCSS files.')
     parser.add_argument('-f', '--file', type=str, required=True, nargs='+',
                         help='The file(s) to be processed')
+    add_history_arguments(parser)
     args = parser.parse_args()
 
     if not args.file:
         parser.print_usage()
         sys.exit(1)
 
-    sass_variables, css_variables = {}, {}
+    sass_variables, css_variables = VariableOccurrences(), VariableOccurrences()
 
     for filename in args.file:
         content = get_file_content(filename)
         sass_variables = add_variables(
             sass_variables, get_sass_variables(content), filename)
-        css_variables_by_id = get_css_variables_by_id(content, filename)
-        for variables in css_variables_by_id:
-            css_variables = add_variables(
-                css_variables, variables["data"], variables["filename"], variables["id"])
+        for id, variable, value in get_css_variables_by_id(content):
+            css_variables.add(variable, value, filename, id)
 
         print(f'Processed {filename}')
 
     save_unique_variables(css_variables, "unique_css_variables.css")
     save_unique_variables(sass_variables, "unique_sass_variables.css")
-    analyze_variables_by_file(sass_variables, "processed_sass_variables.scss")
-    analyze_variables_by_file(
+    sass_categories = analyze_variables_by_file(sass_variables, "processed_sass_variables.scss")
+    css_categories = analyze_variables_by_file(
         css_variables, "processed_css_variables.scss", is_css=True)
 
+    history_database = get_history_database(args)
+    if history_database:
+        results = {f"{category}_sass_variables": counts for category, counts in sass_categories.items()}
+        results.update({f"{category}_css_variables": counts for category, counts in css_categories.items()})
+        record_run(history_database, "process_sass_variables", results)
+
 
 if __name__ == "__main__":
     main()
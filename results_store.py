@@ -0,0 +1,262 @@
+import argparse
+import sqlite3
+import subprocess
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, Mapping, Optional, Union
+
+# Example:
+#   python3 results_store.py runs
+#   python3 results_store.py trend -s find_unused_images_fast -k unused_images
+#   python3 results_store.py diff -s process_sass_variables -k conflicting_css_variables
+
+DEFAULT_DATABASE = "analysis_history.db"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    script TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    git_commit TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_by_script ON runs (script, id);
+
+CREATE TABLE IF NOT EXISTS run_totals (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    kind TEXT NOT NULL,
+    items INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    PRIMARY KEY (run_id, kind)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS names (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    item TEXT NOT NULL,
+    UNIQUE (kind, item)
+);
+
+CREATE TABLE IF NOT EXISTS items (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    name_id INTEGER NOT NULL REFERENCES names (id),
+    count INTEGER NOT NULL,
+    PRIMARY KEY (run_id, name_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS items_by_name ON items (name_id, run_id);
+"""
+
+
+def add_history_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--history-db', type=str, default=DEFAULT_DATABASE,
+                        help='SQLite database the results of this run are appended to')
+    parser.add_argument('--no-history', action='store_true',
+                        help='Do not record this run in the history database')
+
+
+def get_history_database(args: argparse.Namespace) -> Optional[str]:
+    return None if args.no_history else args.history_db
+
+
+def connect(database: str) -> sqlite3.Connection:
+    """Opens the history database for writing, creating it and its schema if missing."""
+    connection = sqlite3.connect(database)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def connect_read_only(database: str) -> sqlite3.Connection:
+    """Opens an existing history database for queries. Exits if it doesn't exist."""
+    path = Path(database)
+    if not path.is_file():
+        print(f"History database {database} does not exist")
+        sys.exit(1)
+    return sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True)
+
+
+def get_git_commit() -> Optional[str]:
+    """Returns the commit checked out in the current directory, or None outside a git repository."""
+    try:
+        result = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def record_run(database: str, script: str, results: Dict[str, Union[Mapping[str, int], Iterable[str]]]) -> int:
+    """
+    Append the results of a run to the history database in a single transaction.
+    Item names are stored once in `names` and runs reference them by id.
+
+    Parameters:
+    - database (str): Path to the SQLite database, created if missing.
+    - script (str): Name of the script that produced the results.
+    - results (Dict): kind (e.g. unused_images) -> items, either a mapping of item to
+      count or an iterable of items that are each counted once.
+
+    Returns:
+    - run_id: id of the recorded run
+    """
+    connection = connect(database)
+    try:
+        with connection:
+            run_id = connection.execute(
+                "INSERT INTO runs (script, created_at, git_commit) VALUES (?, ?, ?)",
+                (script, datetime.now(timezone.utc).isoformat(timespec="seconds"), get_git_commit())).lastrowid
+            for kind, items in results.items():
+                counts = Counter(items) if not isinstance(items, Mapping) else Counter(dict(items))
+                connection.executemany(
+                    "INSERT OR IGNORE INTO names (kind, item) VALUES (?, ?)",
+                    ((kind, item) for item in counts))
+                connection.executemany(
+                    "INSERT INTO items (run_id, name_id, count) "
+                    "SELECT ?, id, ? FROM names WHERE kind = ? AND item = ?",
+                    ((run_id, count, kind, item) for item, count in counts.items()))
+                connection.execute(
+                    "INSERT INTO run_totals (run_id, kind, items, total) VALUES (?, ?, ?, ?)",
+                    (run_id, kind, len(counts), sum(counts.values())))
+    finally:
+        connection.close()
+    print(f'Recorded run {run_id} in {database}')
+    return run_id
+
+
+def get_runs(connection: sqlite3.Connection, script: Optional[str] = None, limit: int = 20) -> List[tuple]:
+    """Returns the most recent (id, script, created_at, git_commit) runs, newest first."""
+    if script:
+        return connection.execute(
+            "SELECT id, script, created_at, git_commit FROM runs WHERE script = ? ORDER BY id DESC LIMIT ?",
+            (script, limit)).fetchall()
+    return connection.execute(
+        "SELECT id, script, created_at, git_commit FROM runs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+
+
+def get_trend(connection: sqlite3.Connection, script: str, kind: Optional[str] = None,
+              limit: int = 20) -> List[tuple]:
+    """Returns (run id, created_at, git_commit, kind, items, total) rows for recent runs of a script."""
+    query = """
+        SELECT runs.id, runs.created_at, runs.git_commit, run_totals.kind, run_totals.items, run_totals.total
+        FROM (SELECT * FROM runs WHERE script = ? ORDER BY id DESC LIMIT ?) AS runs
+        JOIN run_totals ON run_totals.run_id = runs.id
+        {} ORDER BY runs.id DESC, run_totals.kind
+    """
+    if kind:
+        return connection.execute(query.format("WHERE run_totals.kind = ?"), (script, limit, kind)).fetchall()
+    return connection.execute(query.format(""), (script, limit)).fetchall()
+
+
+def check_runs(connection: sqlite3.Connection, run_ids: List[int], kind: str) -> Optional[str]:
+    """Returns a message if a run doesn't exist or didn't record the kind, otherwise None."""
+    for run_id in run_ids:
+        if not connection.execute("SELECT 1 FROM runs WHERE id = ?", (run_id,)).fetchone():
+            return f"Run {run_id} does not exist"
+        if not connection.execute("SELECT 1 FROM run_totals WHERE run_id = ? AND kind = ?",
+                                  (run_id, kind)).fetchone():
+            kinds = [row[0] for row in connection.execute(
+                "SELECT kind FROM run_totals WHERE run_id = ? ORDER BY kind", (run_id,))]
+            return f"Run {run_id} did not record {kind}, it has: {', '.join(kinds) or 'nothing'}"
+    return None
+
+
+def get_diff(connection: sqlite3.Connection, old_run: int, new_run: int, kind: str) -> Dict[str, List[tuple]]:
+    """
+    Compare the items of a kind between two runs.
+
+    Returns:
+    - diff: dict with `added` and `removed` (item, count) rows and `changed`
+      (item, old count, new count) rows
+    """
+    only_in = """
+        SELECT names.item, a.count FROM items AS a JOIN names ON names.id = a.name_id
+        WHERE a.run_id = ? AND names.kind = ?
+        AND NOT EXISTS (SELECT 1 FROM items AS b WHERE b.run_id = ? AND b.name_id = a.name_id)
+        ORDER BY names.item
+    """
+    changed = """
+        SELECT names.item, b.count, a.count FROM items AS a JOIN names ON names.id = a.name_id
+        JOIN items AS b ON b.run_id = ? AND b.name_id = a.name_id
+        WHERE a.run_id = ? AND names.kind = ? AND a.count != b.count
+        ORDER BY names.item
+    """
+    return {"added": connection.execute(only_in, (new_run, kind, old_run)).fetchall(),
+            "removed": connection.execute(only_in, (old_run, kind, new_run)).fetchall(),
+            "changed": connection.execute(changed, (old_run, new_run, kind)).fetchall()}
+
+
+def main() -> None:
+    # Accept --history-db both before and after the command. Subcommands suppress the
+    # default so they don't overwrite a value given before the command.
+    history_parser = argparse.ArgumentParser(add_help=False)
+    history_parser.add_argument('--history-db', type=str, default=argparse.SUPPRESS,
+                                help=f'SQLite database with recorded runs (default {DEFAULT_DATABASE})')
+    parser = argparse.ArgumentParser(description='Query the history of analysis runs.',
+                                     parents=[history_parser])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    runs_parser = subparsers.add_parser('runs', parents=[history_parser], help='List recent runs')
+    runs_parser.add_argument('-s', '--script', type=str, help='Only list runs of this script')
+    runs_parser.add_argument('-n', '--limit', type=int, default=20, help='Number of runs to list')
+
+    trend_parser = subparsers.add_parser('trend', parents=[history_parser],
+                                         help='Show item counts over recent runs of a script')
+    trend_parser.add_argument('-s', '--script', type=str, required=True, help='Script to show runs of')
+    trend_parser.add_argument('-k', '--kind', type=str, help='Only show this kind, e.g. unused_images')
+    trend_parser.add_argument('-n', '--limit', type=int, default=20, help='Number of runs to show')
+
+    diff_parser = subparsers.add_parser('diff', parents=[history_parser],
+                                        help='Show items added or removed between two runs')
+    diff_parser.add_argument('-k', '--kind', type=str, required=True, help='Kind to compare, e.g. unused_images')
+    diff_parser.add_argument('-s', '--script', type=str, help='Compare the two latest runs of this script')
+    diff_parser.add_argument('runs', type=int, nargs='*', help='Old and new run id')
+    args = parser.parse_args()
+
+    connection = connect_read_only(getattr(args, 'history_db', DEFAULT_DATABASE))
+
+    if args.command == 'runs':
+        for run_id, script, created_at, git_commit in get_runs(connection, args.script, args.limit):
+            print(f"{run_id}\t{script}\t{created_at}\t{git_commit or ''}")
+
+    elif args.command == 'trend':
+        print("run\tcreated_at\tgit_commit\tkind\titems\ttotal")
+        for run_id, created_at, git_commit, kind, items, total in get_trend(
+                connection, args.script, args.kind, args.limit):
+            print(f"{run_id}\t{created_at}\t{(git_commit or '')[:12]}\t{kind}\t{items}\t{total}")
+
+    elif args.command == 'diff':
+        if len(args.runs) == 2:
+            old_run, new_run = args.runs
+        elif args.script and not args.runs:
+            runs = get_runs(connection, args.script, 2)
+            if len(runs) < 2:
+                print(f"Need at least two runs of {args.script} to compare")
+                sys.exit(1)
+            new_run, old_run = runs[0][0], runs[1][0]
+        else:
+            diff_parser.print_usage()
+            sys.exit(1)
+
+        missing = check_runs(connection, [old_run, new_run], args.kind)
+        if missing:
+            print(missing)
+            sys.exit(1)
+
+        diff = get_diff(connection, old_run, new_run, args.kind)
+        print(f"// {args.kind}: run {old_run} -> run {new_run}")
+        for item, count in diff["added"]:
+            print(f"+ {item} ({count})")
+        for item, count in diff["removed"]:
+            print(f"- {item} ({count})")
+        for item, old_count, new_count in diff["changed"]:
+            print(f"~ {item} ({old_count} -> {new_count})")
+        print(f"{len(diff['added'])} added, {len(diff['removed'])} removed, {len(diff['changed'])} changed")
+
+    connection.close()
+
+
+if __name__ == "__main__":
+    start_time = time.perf_counter()
+    main()
+    end_time = time.perf_counter()
+    elapsed_time = end_time - start_time
+    print(f"Time taken to complete main method: {elapsed_time:.2f} seconds")
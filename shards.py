@@ -0,0 +1,186 @@
+import argparse
+import hashlib
+import json
+import sys
+import time
+import zlib
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from results_store import add_history_arguments, get_history_database
+
+# Example:
+#   python3 analyze_css_properties.py -d src --shard 1/4    (one per runner, 1/4 ... 4/4)
+#   python3 shards.py merge css_properties.shard-*-of-4.json
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """
+    Parse a `--shard i/N` argument where 1 <= i <= N.
+
+    Returns:
+    - shard: (index, count) tuple
+    """
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard must look like i/N, got {value}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 1 and {count}, got {index}")
+    return index, count
+
+
+def in_shard(path, shard: Tuple[int, int]) -> bool:
+    """
+    Deterministically assign a file to a shard by hashing its path, so every runner
+    agrees on the partition without coordinating.
+    """
+    index, count = shard
+    return zlib.crc32(Path(path).as_posix().encode()) % count == index - 1
+
+
+def select_shard(files: List, shard: Tuple[int, int]) -> List[Tuple[int, object]]:
+    """
+    Pick the files belonging to a shard.
+
+    Parameters:
+    - files (List): Full, ordered list of files every shard sees.
+    - shard (Tuple): (index, count) from parse_shard.
+
+    Returns:
+    - files: list of (position in the full list, file) pairs in this shard
+    """
+    return [(position, file) for position, file in enumerate(files) if in_shard(file, shard)]
+
+
+def partial_filename(kind: str, shard: Tuple[int, int]) -> str:
+    index, count = shard
+    return f"{kind}.shard-{index}-of-{count}.json"
+
+
+def digest_inputs(inputs: List[List]) -> str:
+    """Hashes the ordered lists of inputs a run saw, so partials from different inputs can't be merged."""
+    digest = hashlib.blake2b(digest_size=16)
+    for paths in inputs:
+        for path in paths:
+            digest.update(Path(path).as_posix().encode() + b"\0")
+        digest.update(b"\1")
+    return digest.hexdigest()
+
+
+def write_partial(kind: str, shard: Tuple[int, int], inputs: List[List], data: Dict) -> str:
+    """
+    Writes a compact partial result file for a shard and returns its name.
+
+    Parameters:
+    - kind (str): Kind of partial result, e.g. css_properties.
+    - shard (Tuple): (index, count) from parse_shard.
+    - inputs (List): Full, ordered lists of inputs every shard sees. Only their digest is stored.
+    - data (Dict): Results of this shard.
+    """
+    filename = partial_filename(kind, shard)
+    with open(filename, "w") as f:
+        json.dump({"kind": kind, "shard": list(shard), "inputs_digest": digest_inputs(inputs), **data},
+                  f, separators=(',', ':'))
+    return filename
+
+
+def count_by_first_occurrence(items_by_file) -> Dict:
+    """
+    Count items while remembering where each was first seen.
+
+    Parameters:
+    - items_by_file (iterable): (position of the file, list of items) pairs, in file order.
+
+    Returns:
+    - counts: dict of item -> [count, file position, position within the file]
+    """
+    counts = {}
+    for file_position, items in items_by_file:
+        for item_position, item in enumerate(items):
+            if item in counts:
+                counts[item][0] += 1
+            else:
+                counts[item] = [1, file_position, item_position]
+    return counts
+
+
+def merge_counts(entries: List[List]) -> Counter:
+    """
+    Merge [*item, count, file position, position within the file] rows from several
+    shards into a Counter whose insertion order matches a single run over all files.
+    """
+    merged = {}
+    for *item, count, file_position, item_position in entries:
+        item = tuple(item) if len(item) > 1 else item[0]
+        first_seen = (file_position, item_position)
+        if item in merged:
+            merged[item][0] += count
+            merged[item][1] = min(merged[item][1], first_seen)
+        else:
+            merged[item] = [count, first_seen]
+    ordered = sorted(merged.items(), key=lambda x: x[1][1])
+    return Counter({item: count for item, (count, _) in ordered})
+
+
+def read_partials(filenames: List[str]) -> Dict[str, List[Dict]]:
+    """
+    Reads partial result files and groups them by kind, checking every shard is present
+    once and that every shard saw the same inputs.
+    """
+    partials = defaultdict(list)
+    for filename in filenames:
+        try:
+            with open(filename, 'r') as f:
+                partial = json.load(f)
+        except (IOError, ValueError) as e:
+            print(f"Error reading partial result {filename}: {e}")
+            sys.exit(1)
+        if not isinstance(partial, dict) or any(key not in partial for key in ("kind", "shard", "inputs_digest")):
+            print(f"{filename} is not a partial result written with --shard")
+            sys.exit(1)
+        partials[partial["kind"]].append(partial)
+
+    for kind, group in partials.items():
+        counts = {partial["shard"][1] for partial in group}
+        indices = sorted(partial["shard"][0] for partial in group)
+        if len(counts) != 1 or indices != list(range(1, counts.pop() + 1)):
+            print(f"Partial results for {kind} do not cover every shard exactly once: "
+                  f"{[partial['shard'] for partial in group]}")
+            sys.exit(1)
+        if len({partial["inputs_digest"] for partial in group}) != 1:
+            print(f"Partial results for {kind} were run on different files, "
+                  f"check every shard was given the same arguments")
+            sys.exit(1)
+    return partials
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Merge partial results written with --shard.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    merge_parser = subparsers.add_parser('merge', help='Merge partial result files')
+    merge_parser.add_argument('partials', type=str, nargs='+',
+                              help='Partial result files from every shard')
+    add_history_arguments(merge_parser)
+    args = parser.parse_args()
+
+    partials = read_partials(args.partials)
+    history_database = get_history_database(args)
+
+    if "css_properties" in partials:
+        import analyze_css_properties
+        analyze_css_properties.merge_partials(partials["css_properties"], history_database)
+    if "images" in partials:
+        import find_unused_images_fast
+        find_unused_images_fast.merge_partials(partials["images"], history_database)
+
+    print(f'Merged {len(args.partials)} partial results')
+
+
+if __name__ == "__main__":
+    start_time = time.perf_counter()
+    main()
+    end_time = time.perf_counter()
+    elapsed_time = end_time - start_time
+    print(f"Time taken to complete main method: {elapsed_time:.2f} seconds")